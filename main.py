@@ -6,17 +6,22 @@ MiniMax Video Generation Tool
 
 import asyncio
 import base64
-import json
+import hashlib
 import os
+import random
 import time
 import uuid
-from typing import Dict, List, Optional
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass
+from typing import Deque, Dict, List, Optional, Set, Tuple
 from pathlib import Path
 
+import aiofiles
 import httpx
-from fastapi import FastAPI, File, Form, UploadFile, WebSocket, WebSocketDisconnect, Request
+import orjson
+from fastapi import FastAPI, File, Form, UploadFile, WebSocket, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse, Response
 from pydantic import BaseModel
 import uvicorn
 
@@ -24,13 +29,40 @@ import uvicorn
 UPLOAD_DIR = Path("uploads")
 STATIC_DIR = Path("static")
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 上传文件分块写入大小
+# 允许上传的图片扩展名及其MIME类型（不含SVG等可执行脚本的格式）
+ALLOWED_IMAGE_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+    ".gif": "image/gif"
+}
+# 每种图片类型保存时统一使用的扩展名
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif"
+}
+POLL_BASE_DELAY = 5  # 首次查询任务状态的等待秒数
+POLL_MAX_DELAY = 60  # 查询间隔上限
+WS_BATCH_DELAY = 0.05  # WebSocket消息合并发送的等待秒数
+JOB_QUEUE_SIZE = 10000  # 等待处理的视频生成任务上限
+JOB_WORKERS = 50  # 同时处理的视频生成任务数
+MAX_JOBS_PER_API_KEY = 5  # 同一API Key同时处理的任务数，避免触发限流
+ADMIN_STATS_TTL = 5  # 管理员统计数据缓存秒数
 
 # 确保目录存在
 UPLOAD_DIR.mkdir(exist_ok=True)
 STATIC_DIR.mkdir(exist_ok=True)
 
 # 创建FastAPI应用
-app = FastAPI(title="MiniMax Video Generation Tool", version="1.0.0")
+app = FastAPI(
+    title="MiniMax Video Generation Tool",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # 挂载静态文件
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -39,29 +71,40 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 tasks_storage: Dict[str, dict] = {}
 websocket_connections: Dict[str, WebSocket] = {}
 
-# 用户统计数据
-user_statistics: Dict[str, dict] = {
-    # session_id: {
-    #     "api_key_prefix": "sk-xxx...",
-    #     "request_count": 0,
-    #     "success_count": 0, 
-    #     "fail_count": 0,
-    #     "last_active": timestamp,
-    #     "created_at": timestamp,
-    #     "user_ip": "x.x.x.x"
-    # }
-}
+# 统计数据结构（使用__slots__，每条记录比dict更省内存）
+@dataclass
+class UserStat:
+    __slots__ = ("api_key_prefix", "request_count", "success_count", "fail_count",
+                 "last_active", "created_at", "user_ip")
+    api_key_prefix: str
+    request_count: int
+    success_count: int
+    fail_count: int
+    last_active: float
+    created_at: float
+    user_ip: str
 
-# API Key统计
-api_key_statistics: Dict[str, dict] = {
-    # "sk-xxx...": {
-    #     "request_count": 0,
-    #     "success_count": 0,
-    #     "fail_count": 0,
-    #     "last_used": timestamp,
-    #     "sessions": ["session1", "session2"]
-    # }
-}
+@dataclass
+class ApiKeyStat:
+    __slots__ = ("request_count", "success_count", "fail_count", "last_used", "sessions")
+    request_count: int
+    success_count: int
+    fail_count: int
+    last_used: float
+    sessions: Set[str]
+
+# 用户统计数据（session_id -> UserStat）
+user_statistics: Dict[str, UserStat] = {}
+
+# API Key统计（API Key后缀 -> ApiKeyStat）
+api_key_statistics: Dict[str, ApiKeyStat] = {}
+
+# 每个API Key（按完整Key的哈希区分）正在处理的任务数，以及超出上限后暂存的任务
+active_jobs_per_key: Dict[str, int] = defaultdict(int)
+parked_jobs: Dict[str, Deque[tuple]] = defaultdict(deque)
+
+# 管理员统计数据缓存
+admin_stats_cache: dict = {"content": None, "expires_at": 0.0}
 
 # 数据模型
 class VideoGenerationRequest(BaseModel):
@@ -75,7 +118,7 @@ class VideoGenerationRequest(BaseModel):
     duration: int = 6
     resolution: str = "768P"
     fast_pretreatment: bool = False
-    images: List[str] = []  # base64编码的图片
+    image_file_ids: List[str] = []  # /api/upload返回的file_id
 
 
 
@@ -90,28 +133,67 @@ class TaskStatus(BaseModel):
     created_at: float
     updated_at: float
 
+def new_task_record(task_id: str, now: float) -> dict:
+    """创建新任务的存储记录（字段与TaskStatus一致，直接构造dict避免模型校验开销）"""
+    return {
+        "task_id": task_id,
+        "status": "waiting",
+        "progress": 0,
+        "message": "排队等待处理...",
+        "trace_id": "",
+        "video_url": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now
+    }
+
 # WebSocket连接管理器
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        # 每个session_id是一个频道，可以有多个订阅的WebSocket连接
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        # 待发送的消息，在短时间窗口内合并为一帧发送
+        self.pending: Dict[str, List[dict]] = defaultdict(list)
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
 
     async def connect(self, websocket: WebSocket, session_id: str):
         await websocket.accept()
-        self.active_connections[session_id] = websocket
+        self.active_connections.setdefault(session_id, set()).add(websocket)
         print(f"WebSocket connection established for session: {session_id}")
 
-    def disconnect(self, session_id: str):
-        if session_id in self.active_connections:
-            del self.active_connections[session_id]
+    def disconnect(self, websocket: WebSocket, session_id: str):
+        subscribers = self.active_connections.get(session_id)
+        if subscribers is not None and websocket in subscribers:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.active_connections[session_id]
             print(f"WebSocket connection closed for session: {session_id}")
 
+    def connection_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self.active_connections.values())
+
     async def send_personal_message(self, message: dict, session_id: str):
-        if session_id in self.active_connections:
+        if not self.active_connections.get(session_id):
+            return
+        self.pending[session_id].append(message)
+        if session_id not in self.flush_tasks:
+            self.flush_tasks[session_id] = asyncio.create_task(self._flush_later(session_id))
+
+    async def _flush_later(self, session_id: str):
+        await asyncio.sleep(WS_BATCH_DELAY)
+        del self.flush_tasks[session_id]
+        updates = self.pending.pop(session_id, [])
+        subscribers = self.active_connections.get(session_id)
+        if not updates or not subscribers:
+            return
+        # 只序列化一次，发送给频道内的所有连接
+        data = orjson.dumps({"type": "batch", "updates": updates})
+        for websocket in list(subscribers):
             try:
-                await self.active_connections[session_id].send_text(json.dumps(message))
+                await websocket.send_bytes(data)
             except:
                 # 连接已断开，移除
-                self.disconnect(session_id)
+                self.disconnect(websocket, session_id)
 
 manager = ConnectionManager()
 
@@ -122,6 +204,10 @@ def get_api_key_prefix(api_key: str) -> str:
         return "..." + api_key
     return "..." + api_key[-10:]
 
+def get_api_key_id(api_key: str) -> str:
+    """获取完整API Key的哈希，用于按Key限流（后缀可能重复，只用于显示）"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
 def update_user_statistics(session_id: str, api_key: str, client_ip: str, status: str = "request"):
     """更新用户统计信息"""
     api_key_prefix = get_api_key_prefix(api_key)
@@ -129,48 +215,42 @@ def update_user_statistics(session_id: str, api_key: str, client_ip: str, status
     
     # 更新用户统计
     if session_id not in user_statistics:
-        user_statistics[session_id] = {
-            "api_key_prefix": api_key_prefix,
-            "request_count": 0,
-            "success_count": 0,
-            "fail_count": 0,
-            "last_active": current_time,
-            "created_at": current_time,
-            "user_ip": client_ip
-        }
-    
-    user_stats = user_statistics[session_id]
-    user_stats["last_active"] = current_time
+        user_statistics[session_id] = UserStat(
+            api_key_prefix=api_key_prefix,
+            request_count=0,
+            success_count=0,
+            fail_count=0,
+            last_active=current_time,
+            created_at=current_time,
+            user_ip=client_ip
+        )
     
-    if status == "request":
-        user_stats["request_count"] += 1
-    elif status == "success":
-        user_stats["success_count"] += 1
-    elif status == "fail":
-        user_stats["fail_count"] += 1
+    user_statistics[session_id].last_active = current_time
     
     # 更新API Key统计
     if api_key_prefix not in api_key_statistics:
-        api_key_statistics[api_key_prefix] = {
-            "request_count": 0,
-            "success_count": 0,
-            "fail_count": 0,
-            "last_used": current_time,
-            "sessions": []
-        }
+        api_key_statistics[api_key_prefix] = ApiKeyStat(
+            request_count=0,
+            success_count=0,
+            fail_count=0,
+            last_used=current_time,
+            sessions=set()
+        )
     
     api_stats = api_key_statistics[api_key_prefix]
-    api_stats["last_used"] = current_time
+    api_stats.last_used = current_time
     
-    if session_id not in api_stats["sessions"]:
-        api_stats["sessions"].append(session_id)
+    api_stats.sessions.add(session_id)
     
-    if status == "request":
-        api_stats["request_count"] += 1
-    elif status == "success":
-        api_stats["success_count"] += 1
-    elif status == "fail":
-        api_stats["fail_count"] += 1
+    increment_statistics(session_id, api_key_prefix, status)
+
+def increment_statistics(session_id: str, api_key_prefix: str, status: str):
+    """同时累加用户和API Key的计数（request/success/fail）"""
+    # 所有计数都在事件循环线程内同步完成，中间没有await，无需加锁
+    counter = f"{status}_count"
+    for stats in (user_statistics.get(session_id), api_key_statistics.get(api_key_prefix)):
+        if stats is not None:
+            setattr(stats, counter, getattr(stats, counter) + 1)
 
 def cleanup_old_data():
     """清理超过1小时未活跃的用户数据"""
@@ -178,35 +258,26 @@ def cleanup_old_data():
     one_hour_ago = current_time - 3600  # 1小时
     
     # 清理用户统计
-    to_remove_users = []
-    for session_id, stats in user_statistics.items():
-        if stats["last_active"] < one_hour_ago:
-            to_remove_users.append(session_id)
-    
+    to_remove_users = [
+        session_id for session_id, stats in user_statistics.items()
+        if stats.last_active < one_hour_ago
+    ]
     for session_id in to_remove_users:
         del user_statistics[session_id]
-        # 清理对应的任务数据
-        to_remove_tasks = []
-        for task_id, task_data in tasks_storage.items():
-            # 这里需要根据session_id匹配任务，暂时清理旧任务
-            if task_data.get("created_at", 0) < one_hour_ago:
-                to_remove_tasks.append(task_id)
-        
-        for task_id in to_remove_tasks:
-            del tasks_storage[task_id]
+
+    # 清理旧任务数据（单次遍历，不再按用户重复扫描；仍在队列中等待的任务保留）
+    to_remove_tasks = [
+        task_id for task_id, task_data in tasks_storage.items()
+        if task_data.get("created_at", 0) < one_hour_ago and task_data.get("status") != "waiting"
+    ]
+    for task_id in to_remove_tasks:
+        del tasks_storage[task_id]
     
     # 清理API Key统计中的无效sessions
     for api_key, stats in api_key_statistics.items():
-        stats["sessions"] = [s for s in stats["sessions"] if s in user_statistics]
+        stats.sessions.intersection_update(user_statistics)
 
-@app.get("/", response_class=HTMLResponse)
-async def read_root():
-    """返回主页面"""
-    index_file = STATIC_DIR / "index.html"
-    if index_file.exists():
-        return HTMLResponse(content=index_file.read_text(encoding="utf-8"))
-    else:
-        return HTMLResponse("""
+INDEX_NOT_FOUND_HTML = """
         <!DOCTYPE html>
         <html>
         <head>
@@ -217,7 +288,67 @@ async def read_root():
             <p>前端文件未找到，请检查 static/index.html 文件是否存在。</p>
         </body>
         </html>
-        """)
+        """
+
+def load_html_page(content: bytes) -> Tuple[bytes, str]:
+    """预先计算页面内容的ETag"""
+    etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+    return content, etag
+
+def html_page_response(request: Request, page: Tuple[bytes, str]) -> Response:
+    """返回缓存的HTML页面，ETag匹配时返回304"""
+    content, etag = page
+    headers = {"Cache-Control": "public, max-age=300", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=content, headers=headers)
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
+    """返回主页面"""
+    return html_page_response(request, app.state.index_page)
+
+async def save_upload(file: UploadFile, file_ext: str) -> Optional[Tuple[str, int]]:
+    """分块写入上传的文件，按内容哈希命名（相同图片只保存一份）
+    
+    file_ext必须是ALLOWED_IMAGE_TYPES中的扩展名。
+    返回 (file_id, 文件大小)，超过大小限制时返回None
+    """
+    temp_path = UPLOAD_DIR / f".{uuid.uuid4().hex}.part"
+    hasher = hashlib.blake2b(digest_size=16)
+    total = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > MAX_FILE_SIZE:
+                    return None
+                hasher.update(chunk)
+                await f.write(chunk)
+        
+        # 扩展名统一为白名单中的标准形式，相同内容始终得到相同的file_id
+        file_id = f"{hasher.hexdigest()}{IMAGE_EXTENSIONS[ALLOWED_IMAGE_TYPES[file_ext]]}"
+        file_path = UPLOAD_DIR / file_id
+        if not file_path.exists():
+            os.replace(temp_path, file_path)
+        return file_id, total
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def get_upload_path(file_id: str) -> Optional[Path]:
+    """根据file_id获取上传文件路径，file_id无效时返回None"""
+    if not file_id or Path(file_id).name != file_id:
+        return None
+    if Path(file_id).suffix not in ALLOWED_IMAGE_TYPES:
+        return None
+    file_path = UPLOAD_DIR / file_id
+    return file_path if file_path.is_file() else None
+
+def load_image_data_url(file_path: Path) -> str:
+    """读取上传的图片并转换为base64 data URL"""
+    mime_type = ALLOWED_IMAGE_TYPES[file_path.suffix]
+    base64_data = base64.b64encode(file_path.read_bytes()).decode()
+    return f"data:{mime_type};base64,{base64_data}"
 
 @app.post("/api/upload")
 async def upload_files(files: List[UploadFile] = File(...)):
@@ -228,40 +359,60 @@ async def upload_files(files: List[UploadFile] = File(...)):
         if not file.content_type.startswith('image/'):
             continue
             
-        # 检查文件大小
-        contents = await file.read()
-        if len(contents) > MAX_FILE_SIZE:
+        # 检查文件大小（已知大小时直接跳过，未知时在写入过程中检查）
+        if file.size is not None and file.size > MAX_FILE_SIZE:
             continue
             
-        # 生成唯一文件名
-        file_id = str(uuid.uuid4())
-        file_ext = Path(file.filename).suffix
-        file_path = UPLOAD_DIR / f"{file_id}{file_ext}"
-        
-        # 保存文件
-        with open(file_path, "wb") as f:
-            f.write(contents)
+        # 只接受白名单中的图片扩展名
+        file_ext = Path(file.filename or "").suffix.lower()
+        if file_ext not in ALLOWED_IMAGE_TYPES:
+            continue
             
-        # 转换为base64
-        base64_data = base64.b64encode(contents).decode()
-        mime_type = file.content_type or "image/jpeg"
-        data_url = f"data:{mime_type};base64,{base64_data}"
+        # 保存文件（file_id即保存的文件名）
+        saved = await save_upload(file, file_ext)
+        if saved is None:
+            continue
+        file_id, file_size = saved
         
         uploaded_files.append({
             "file_id": file_id,
             "filename": file.filename,
-            "size": len(contents),
-            "data_url": data_url
+            "size": file_size,
+            "url": f"/uploads/{file_id}"
         })
     
-    return JSONResponse({
+    return ORJSONResponse({
         "success": True,
         "files": uploaded_files
     })
 
+@app.get("/uploads/{file_id}")
+async def get_upload(file_id: str):
+    """返回上传的图片（固定图片Content-Type，禁止浏览器嗅探内容类型）"""
+    file_path = get_upload_path(file_id)
+    if file_path is None:
+        return ORJSONResponse({"error": "图片不存在"}, status_code=404)
+    return FileResponse(
+        file_path,
+        media_type=ALLOWED_IMAGE_TYPES[file_path.suffix],
+        headers={"X-Content-Type-Options": "nosniff"}
+    )
+
 @app.post("/api/generate")
 async def generate_videos(request: VideoGenerationRequest, req: Request):
     """创建视频生成任务"""
+    # 校验图片
+    for file_id in request.image_file_ids:
+        if get_upload_path(file_id) is None:
+            return ORJSONResponse({"error": f"图片不存在: {file_id}"}, status_code=400)
+    
+    # 检查任务队列容量
+    job_queue: asyncio.Queue = app.state.job_queue
+    task_count = max(len(request.image_file_ids), 1) * request.videos_per_image
+    queued_count = job_queue.qsize() + sum(len(jobs) for jobs in parked_jobs.values())
+    if job_queue.maxsize - queued_count < task_count:
+        return ORJSONResponse({"error": "任务队列已满，请稍后再试"}, status_code=503)
+    
     session_id = str(uuid.uuid4())
     tasks = []
     
@@ -273,63 +424,45 @@ async def generate_videos(request: VideoGenerationRequest, req: Request):
     
     # 准备任务信息列表
     task_info_list = []
+    now = time.time()
     
     # 处理任务创建逻辑
-    if request.images and len(request.images) > 0:
+    if request.image_file_ids and len(request.image_file_ids) > 0:
         # 有图片的情况：为每张图片创建任务
-        for i, image_data in enumerate(request.images):
+        for i, image_file_id in enumerate(request.image_file_ids):
             for j in range(request.videos_per_image):
                 task_id = str(uuid.uuid4())
-                task = TaskStatus(
-                    task_id=task_id,
-                    status="waiting",
-                    message="等待批次处理...",
-                    created_at=time.time(),
-                    updated_at=time.time()
-                )
-                
-                tasks_storage[task_id] = task.model_dump()
+                tasks_storage[task_id] = new_task_record(task_id, now)
                 tasks.append(task_id)
-                task_info_list.append((task_id, image_data))
+                task_info_list.append((task_id, image_file_id))
     else:
         # 只有提示词没有图片的情况：创建纯文本视频生成任务
         for j in range(request.videos_per_image):
             task_id = str(uuid.uuid4())
-            task = TaskStatus(
-                task_id=task_id,
-                status="waiting", 
-                message="等待批次处理...",
-                created_at=time.time(),
-                updated_at=time.time()
-            )
-            
-            tasks_storage[task_id] = task.model_dump()
+            tasks_storage[task_id] = new_task_record(task_id, now)
             tasks.append(task_id)
             task_info_list.append((task_id, None))
     
-    # 分批处理任务（每5个一组）
-    asyncio.create_task(
-        process_tasks_in_batches(task_info_list, request, session_id)
-    )
+    # 加入任务队列，由固定数量的后台worker处理
+    base_payload = build_base_payload(request)
+    for task_id, image_file_id in task_info_list:
+        job_queue.put_nowait((task_id, request, base_payload, image_file_id, session_id))
     
-    return JSONResponse({
+    return ORJSONResponse({
         "success": True,
         "session_id": session_id,
         "task_ids": tasks
     })
 
-@app.get("/api/task/{task_id}")
+@app.get("/api/task/{task_id}", response_model=TaskStatus)
 async def get_task_status(task_id: str):
     """获取任务状态"""
     if task_id not in tasks_storage:
-        return JSONResponse({"error": "任务不存在"}, status_code=404)
+        return ORJSONResponse({"error": "任务不存在"}, status_code=404)
     
-    return JSONResponse(tasks_storage[task_id])
+    return ORJSONResponse(tasks_storage[task_id])
 
-@app.get("/admin", response_class=HTMLResponse)
-async def admin_page():
-    """管理员页面"""
-    admin_html = """
+ADMIN_HTML = """
     <!DOCTYPE html>
     <html lang="zh-CN">
     <head>
@@ -492,242 +625,260 @@ async def admin_page():
     </body>
     </html>
     """
-    return HTMLResponse(content=admin_html)
 
-@app.get("/api/admin/stats")
-async def get_admin_stats():
-    """获取管理员统计数据"""
+@app.get("/admin", response_class=HTMLResponse)
+async def admin_page(request: Request):
+    """管理员页面"""
+    return html_page_response(request, app.state.admin_page)
+
+def build_admin_stats() -> bytes:
+    """生成管理员统计数据（已序列化的JSON）"""
     # 清理旧数据
     cleanup_old_data()
     
     # 准备用户统计数据
     users_data = []
     for session_id, stats in user_statistics.items():
-        users_data.append({
-            "session_id": session_id,
-            "api_key_prefix": stats["api_key_prefix"],
-            "request_count": stats["request_count"],
-            "success_count": stats["success_count"],
-            "fail_count": stats["fail_count"],
-            "last_active": stats["last_active"],
-            "created_at": stats["created_at"],
-            "user_ip": stats["user_ip"]
-        })
+        users_data.append({"session_id": session_id, **asdict(stats)})
     
     # 准备API Key统计数据
     api_keys_data = []
     for api_key_prefix, stats in api_key_statistics.items():
         api_keys_data.append({
             "api_key_prefix": api_key_prefix,
-            "request_count": stats["request_count"],
-            "success_count": stats["success_count"],
-            "fail_count": stats["fail_count"],
-            "last_used": stats["last_used"],
-            "sessions": stats["sessions"]
+            "request_count": stats.request_count,
+            "success_count": stats.success_count,
+            "fail_count": stats.fail_count,
+            "last_used": stats.last_used,
+            "sessions": list(stats.sessions)
         })
     
-    return JSONResponse({
+    return orjson.dumps({
         "users": users_data,
         "api_keys": api_keys_data,
         "system": {
             "total_users": len(user_statistics),
             "total_tasks": len(tasks_storage),
-            "active_websockets": len(manager.active_connections),
+            "active_websockets": manager.connection_count(),
             "total_api_keys": len(api_key_statistics)
         }
     })
 
+@app.get("/api/admin/stats")
+async def get_admin_stats():
+    """获取管理员统计数据（缓存几秒，多个管理页面共享同一份结果）"""
+    now = time.monotonic()
+    if admin_stats_cache["content"] is None or now >= admin_stats_cache["expires_at"]:
+        admin_stats_cache["content"] = build_admin_stats()
+        admin_stats_cache["expires_at"] = now + ADMIN_STATS_TTL
+    return Response(content=admin_stats_cache["content"], media_type="application/json")
+
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     """WebSocket连接端点"""
     await manager.connect(websocket, session_id)
     try:
+        # 连接保活由服务端ping帧负责，这里只等待断开，客户端消息直接丢弃
         while True:
-            # 接收消息保持连接活跃
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        manager.disconnect(session_id)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
     except Exception:
-        manager.disconnect(session_id)
+        pass
+    finally:
+        manager.disconnect(websocket, session_id)
 
 
 
-async def process_tasks_in_batches(task_info_list: List[tuple], request: VideoGenerationRequest, session_id: str):
-    """分批处理视频生成任务（每5个一组）"""
-    batch_size = 5
-    total_tasks = len(task_info_list)
-    
-    # 将任务分组
-    for i in range(0, total_tasks, batch_size):
-        batch = task_info_list[i:i+batch_size]
-        current_batch = i // batch_size + 1
-        total_batches = (total_tasks + batch_size - 1) // batch_size
-        
-        print(f"处理第 {current_batch}/{total_batches} 批任务，包含 {len(batch)} 个任务")
-        
-        # 更新当前批次任务状态为准备中
-        for task_id, _ in batch:
-            await update_task_status(task_id, "preparing", f"第{current_batch}批次准备中...", session_id)
-        
-        # 并行处理当前批次的所有任务
-        batch_tasks = []
-        for task_id, image_data in batch:
-            task = asyncio.create_task(
-                process_video_generation(task_id, request, image_data, session_id)
-            )
-            batch_tasks.append(task)
-        
-        # 等待当前批次的所有任务完成
-        await asyncio.gather(*batch_tasks)
-        
-        print(f"第 {current_batch}/{total_batches} 批任务已完成")
-        
-        # 如果还有下一批，稍作等待
-        if i + batch_size < total_tasks:
-            await asyncio.sleep(2)  # 批次间间隔2秒
+async def run_video_job(job: tuple):
+    """处理队列中的单个视频生成任务"""
+    task_id, request, base_payload, image_file_id, session_id = job
+    # 任务记录已被清理时不再提交，避免消耗用户额度生成无人查看的视频
+    if task_id in tasks_storage:
+        await process_video_generation(task_id, request, base_payload, image_file_id, session_id)
 
-async def process_video_generation(task_id: str, request: VideoGenerationRequest, 
-                                 image_data: Optional[str], session_id: str):
+async def video_job_worker(queue: asyncio.Queue):
+    """从任务队列中取出视频生成任务并依次处理
+    
+    同一API Key正在处理的任务达到上限时，新任务先暂存，
+    由处理该Key任务的worker完成当前任务后接着处理，不占用其他worker。
+    """
+    while True:
+        job = await queue.get()
+        try:
+            key_id = get_api_key_id(job[1].api_key)
+            if active_jobs_per_key[key_id] >= MAX_JOBS_PER_API_KEY:
+                parked_jobs[key_id].append(job)
+                continue
+            
+            active_jobs_per_key[key_id] += 1
+            try:
+                while job is not None:
+                    await run_video_job(job)
+                    backlog = parked_jobs.get(key_id)
+                    job = backlog.popleft() if backlog else None
+            finally:
+                active_jobs_per_key[key_id] -= 1
+                if not active_jobs_per_key[key_id]:
+                    del active_jobs_per_key[key_id]
+                if not parked_jobs.get(key_id):
+                    parked_jobs.pop(key_id, None)
+        finally:
+            queue.task_done()
+
+def build_base_payload(request: VideoGenerationRequest) -> dict:
+    """构造同一请求下所有任务共用的API请求字段（不含图片）"""
+    if request.model == 'S2V-01':
+        # S2V-01模型使用subject_reference参数（必须有图片+提示词）
+        # S2V-01不支持duration和resolution参数
+        return {
+            "model": request.model,
+            "prompt": request.prompt,
+            "prompt_optimizer": request.prompt_optimizer,
+            "fast_pretreatment": request.fast_pretreatment
+        }
+    
+    # MiniMax-Hailuo-02模型
+    payload = {
+        "prompt": request.prompt,
+        "model": request.model,
+        "duration": request.duration,
+        "prompt_optimizer": request.prompt_optimizer,
+        # MiniMax-Hailuo-02支持分辨率设置，10秒视频只支持768P
+        "resolution": request.resolution if request.duration == 6 else "768P",
+        "fast_pretreatment": request.fast_pretreatment
+    }
+    if request.watermark:
+        payload["watermark"] = "hailuo"
+    return payload
+
+async def process_video_generation(task_id: str, request: VideoGenerationRequest, base_payload: dict,
+                                 image_file_id: Optional[str], session_id: str):
     """处理单个视频生成任务"""
     try:
         # 更新任务状态
         await update_task_status(task_id, "queueing", "提交任务中...", session_id)
         
-        # 准备API请求数据
+        # 提交时才从磁盘读取图片并编码，不在内存中长期保存
+        image_data = None
+        if image_file_id:
+            image_path = get_upload_path(image_file_id)
+            if image_path is None:
+                await update_task_status(task_id, "fail", "图片文件不存在", session_id)
+                return
+            image_data = await asyncio.to_thread(load_image_data_url, image_path)
+        
+        # 在请求级别的固定字段上补充图片
         if request.model == 'S2V-01':
-            # S2V-01模型使用subject_reference参数（必须有图片+提示词）
-            payload = {
-                "model": request.model,
-                "prompt": request.prompt,
-                "prompt_optimizer": request.prompt_optimizer,
+            payload = base_payload | {
                 "subject_reference": [{
                     "type": "character",
                     "image": [image_data]
                 }]
             }
-            # S2V-01不支持duration和resolution参数
-            
-            # 添加fast_pretreatment参数
-            if hasattr(request, 'fast_pretreatment'):
-                payload["fast_pretreatment"] = request.fast_pretreatment
+        elif image_data:
+            payload = base_payload | {"first_frame_image": image_data}
         else:
-            # MiniMax-Hailuo-02模型
-            payload = {
-                "prompt": request.prompt,
-                "model": request.model,
-                "duration": request.duration,
-                "prompt_optimizer": request.prompt_optimizer
-            }
-            
-            # 如果有图片，添加first_frame_image参数
-            if image_data:
-                payload["first_frame_image"] = image_data
-                
-            if request.watermark:
-                payload["watermark"] = "hailuo"
-                
-            # MiniMax-Hailuo-02支持分辨率设置
-            if request.duration == 6:
-                payload["resolution"] = request.resolution
-            else:
-                payload["resolution"] = "768P"
-                
-            # 添加fast_pretreatment参数
-            if hasattr(request, 'fast_pretreatment'):
-                payload["fast_pretreatment"] = request.fast_pretreatment
+            payload = base_payload
         
         # 发送生成请求
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(
-                f"{request.api_url}/video_generation",
-                headers={
-                    "Authorization": f"Bearer {request.api_key}",
-                    "Content-Type": "application/json"
-                },
-                json=payload
-            )
-            
-            # 获取Trace-ID
-            trace_id = (response.headers.get('X-Minimax-Trace-Id') or 
-                       response.headers.get('x-minimax-trace-id') or 
-                       response.headers.get('Trace-ID') or 
-                       response.headers.get('trace-id') or 
-                       '未获取到')
-            
-            print("Trace-ID:", trace_id)
-            
-            # 更新任务中的trace_id
-            if task_id in tasks_storage:
-                tasks_storage[task_id]["trace_id"] = trace_id
-            
-            if not response.is_success:
-                error_data = response.json() if response.content else {}
-                error_msg = error_data.get('base_resp', {}).get('status_msg', f'API错误: {response.status_code}')
-                await update_task_status(task_id, "fail", f"生成失败: {error_msg}", session_id, error=error_msg)
-                return
-            
-            data = response.json()
-            video_task_id = data.get('task_id')
-            
-            if not video_task_id:
-                await update_task_status(task_id, "fail", "未获取到任务ID", session_id)
-                return
+        client = app.state.http
+        response = await client.post(
+            f"{request.api_url}/video_generation",
+            headers={
+                "Authorization": f"Bearer {request.api_key}",
+                "Content-Type": "application/json"
+            },
+            content=orjson.dumps(payload)
+        )
+        
+        # 获取Trace-ID
+        trace_id = (response.headers.get('X-Minimax-Trace-Id') or 
+                   response.headers.get('x-minimax-trace-id') or 
+                   response.headers.get('Trace-ID') or 
+                   response.headers.get('trace-id') or 
+                   '未获取到')
+        
+        print("Trace-ID:", trace_id)
+        
+        # 更新任务中的trace_id
+        if task_id in tasks_storage:
+            tasks_storage[task_id]["trace_id"] = trace_id
+        
+        if not response.is_success:
+            error_data = response.json() if response.content else {}
+            error_msg = error_data.get('base_resp', {}).get('status_msg', f'API错误: {response.status_code}')
+            await update_task_status(task_id, "fail", f"生成失败: {error_msg}", session_id, error=error_msg)
+            return
+        
+        data = response.json()
+        video_task_id = data.get('task_id')
+        
+        if not video_task_id:
+            await update_task_status(task_id, "fail", "未获取到任务ID", session_id)
+            return
         
         # 轮询任务状态
         await update_task_status(task_id, "queueing", f"队列中... (ID: {video_task_id})", session_id)
         
-        start_time = time.time()
+        start_time = time.monotonic()
         
+        attempt = 0
         while True:
-            await asyncio.sleep(10)  # 等待10秒后查询
+            await asyncio.sleep(poll_delay(attempt))
+            attempt += 1
             
-            async with httpx.AsyncClient(timeout=30) as client:
-                status_response = await client.get(
-                    f"{request.api_url}/query/video_generation",
-                    headers={"Authorization": f"Bearer {request.api_key}"},
-                    params={"task_id": video_task_id}
-                )
-                
-                if not status_response.is_success:
-                    await update_task_status(task_id, "fail", "查询状态失败", session_id)
-                    return
-                
-                status_data = status_response.json()
-                status = status_data.get('status')
-                elapsed_time = int(time.time() - start_time)
+            status_response = await client.get(
+                f"{request.api_url}/query/video_generation",
+                headers={"Authorization": f"Bearer {request.api_key}"},
+                params={"task_id": video_task_id}
+            )
+            
+            if not status_response.is_success:
+                await update_task_status(task_id, "fail", "查询状态失败", session_id)
+                return
+            
+            status_data = status_response.json()
+            status = status_data.get('status')
+            elapsed_time = int(time.monotonic() - start_time)
+            
+            if status == 'Queueing':
+                await update_task_status(task_id, "queueing", f"队列中... (用时: {elapsed_time}秒)", session_id)
+            elif status == 'Processing':
+                await update_task_status(task_id, "processing", f"生成中... (用时: {elapsed_time}秒)", session_id)
+            elif status == 'Success':
+                file_id = status_data.get('file_id')
+                if file_id:
+                    video_url = await get_video_download_url(request.api_url, request.api_key, file_id)
+                    await update_task_status(task_id, "success", f"生成成功 (用时: {elapsed_time}秒)", session_id, video_url=video_url)
+                else:
+                    await update_task_status(task_id, "fail", "获取文件ID失败", session_id)
+                break
+            elif status == 'Fail':
+                await update_task_status(task_id, "fail", f"生成失败 (用时: {elapsed_time}秒)", session_id)
+                break
                 
-                if status == 'Queueing':
-                    await update_task_status(task_id, "queueing", f"队列中... (用时: {elapsed_time}秒)", session_id)
-                elif status == 'Processing':
-                    await update_task_status(task_id, "processing", f"生成中... (用时: {elapsed_time}秒)", session_id)
-                elif status == 'Success':
-                    file_id = status_data.get('file_id')
-                    if file_id:
-                        video_url = await get_video_download_url(request.api_url, request.api_key, file_id)
-                        await update_task_status(task_id, "success", f"生成成功 (用时: {elapsed_time}秒)", session_id, video_url=video_url)
-                    else:
-                        await update_task_status(task_id, "fail", "获取文件ID失败", session_id)
-                    break
-                elif status == 'Fail':
-                    await update_task_status(task_id, "fail", f"生成失败 (用时: {elapsed_time}秒)", session_id)
-                    break
-                    
     except Exception as e:
         await update_task_status(task_id, "fail", f"处理错误: {str(e)}", session_id, error=str(e))
 
+def poll_delay(attempt: int) -> float:
+    """轮询间隔：从5秒开始指数退避，最长60秒，加随机抖动避免同时查询"""
+    delay = min(POLL_MAX_DELAY, POLL_BASE_DELAY * 1.5 ** attempt)
+    return delay * random.uniform(0.8, 1.2)
+
 async def get_video_download_url(api_url: str, api_key: str, file_id: str) -> Optional[str]:
     """获取视频下载链接"""
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.get(
-                f"{api_url}/files/retrieve",
-                headers={"Authorization": f"Bearer {api_key}"},
-                params={"file_id": file_id}
-            )
-            
-            if response.is_success:
-                data = response.json()
-                return data.get('file', {}).get('download_url')
+        client = app.state.http
+        response = await client.get(
+            f"{api_url}/files/retrieve",
+            headers={"Authorization": f"Bearer {api_key}"},
+            params={"file_id": file_id}
+        )
+        
+        if response.is_success:
+            data = response.json()
+            return data.get('file', {}).get('download_url')
     except:
         pass
     return None
@@ -748,20 +899,8 @@ async def update_task_status(task_id: str, status: str, message: str, session_id
             tasks_storage[task_id]["error"] = error
             
         # 更新统计信息
-        if session_id in user_statistics:
-            user_stat = user_statistics[session_id]
-            if status == "success":
-                user_stat["success_count"] += 1
-                # 更新API Key统计
-                api_key_prefix = user_stat["api_key_prefix"]
-                if api_key_prefix in api_key_statistics:
-                    api_key_statistics[api_key_prefix]["success_count"] += 1
-            elif status == "fail":
-                user_stat["fail_count"] += 1
-                # 更新API Key统计
-                api_key_prefix = user_stat["api_key_prefix"]
-                if api_key_prefix in api_key_statistics:
-                    api_key_statistics[api_key_prefix]["fail_count"] += 1
+        if status in ("success", "fail") and session_id in user_statistics:
+            increment_statistics(session_id, user_statistics[session_id].api_key_prefix, status)
             
         # 通过WebSocket发送更新
         await manager.send_personal_message({
@@ -789,9 +928,55 @@ async def startup_event():
     print("📍 访问地址: http://localhost:5211")
     print("🔧 管理员页面: http://localhost:5211/admin")
     
-    # 启动后台清理任务
-    asyncio.create_task(background_cleanup_task())
+    # 预先加载页面内容
+    index_file = STATIC_DIR / "index.html"
+    if index_file.exists():
+        app.state.index_page = load_html_page(index_file.read_bytes())
+    else:
+        app.state.index_page = load_html_page(INDEX_NOT_FOUND_HTML.encode())
+    app.state.admin_page = load_html_page(ADMIN_HTML.encode())
+    
+    # 共享的HTTP客户端，复用到MiniMax API的连接
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    )
+    
+    # 视频生成任务队列及处理worker
+    app.state.job_queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    app.state.job_workers = [
+        asyncio.create_task(video_job_worker(app.state.job_queue))
+        for _ in range(JOB_WORKERS)
+    ]
+    
+    # 启动后台清理任务（保留引用，避免任务被回收并在关闭时取消）
+    app.state.cleanup_task = asyncio.create_task(background_cleanup_task())
     print("🧹 后台清理任务已启动")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时的事件"""
+    app.state.cleanup_task.cancel()
+    for worker in app.state.job_workers:
+        worker.cancel()
+    await app.state.http.aclose()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5211)
\ No newline at end of file
+    # 任务、统计和WebSocket连接都保存在进程内存中，因此只能单进程运行
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=5211,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_ping_interval=20,
+        ws_ping_timeout=20,
+        ws_per_message_deflate=True,
+        # 部署在反向代理之后时，从X-Forwarded-For获取真实客户端IP（仅用于统计）
+        # 只信任FORWARDED_ALLOW_IPS中的代理地址，默认仅本机
+        proxy_headers=True,
+        forwarded_allow_ips=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        workers=1
+    )
\ No newline at end of file